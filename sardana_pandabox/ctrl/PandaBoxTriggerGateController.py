@@ -5,8 +5,10 @@ from sardana import State
 from sardana.pool.pooldefs import SynchDomain, SynchParam
 from sardana.pool.controller import TriggerGateController
 from sardana.pool.controller import Type, Description, DefaultValue
-from pandaboxlib import PandA
+from sardana_pandabox.pandabox import get_pandabox, release_pandabox, \
+    TimedCache
 from functools import wraps, partial
+import socket
 import six
 
 
@@ -44,6 +46,9 @@ class PandaBoxTriggerGateCtrl(TriggerGateController):
     gender = "TriggerGate"
     model = "Panda Box"
 
+    # seconds during which a QUEUED? answer is reused
+    _STATE_TTL = 0.005
+
     ctrl_properties = {
         "pandaboxhostname": {Type: str,
                              Description: "Pandabox hostname"},
@@ -60,23 +65,71 @@ class PandaBoxTriggerGateCtrl(TriggerGateController):
     @handle_error(msg="Init: Connection fail to panda box")
     def __init__(self, inst, props, *args, **kwargs):
         TriggerGateController.__init__(self, inst, props, *args, **kwargs)
-        self.pandabox = PandA(self.pandaboxhostname)
-        self.pandabox.connect_to_panda()
+        self.pandabox = get_pandabox(self.pandaboxhostname)
+        # command strings are formatted once, not on every call
+        block = self.trigger_block
+        self._cmd = {
+            "queued": "{}.QUEUED?".format(block),
+            "enable": "{}.ENABLE=".format(block),
+            "trig": "{}.TRIG=".format(block),
+            "delay": "{}.DELAY=".format(block),
+            "pulses": "{}.PULSES=".format(block),
+            "width": "{}.WIDTH=".format(block),
+            "step": "{}.STEP=".format(block),
+        }
+        self._units_cmds = [
+            "{}.DELAY.UNITS=s".format(block),
+            "{}.WIDTH.UNITS=s".format(block),
+            "{}.STEP.UNITS=s".format(block),
+            "{}.ENABLE.DELAY=0".format(block),
+            "{}.TRIG.DELAY=0".format(block),
+        ]
+        # back to back StateOne calls reuse the last QUEUED? answer
+        self._queued = TimedCache(self._STATE_TTL)
+        self._axes = set()
+
+    def __del__(self):
+        self.release()
+
+    def release(self):
+        """Release the PandABox connection, only the first call does
+        something."""
+        pandabox = getattr(self, "pandabox", None)
+        if pandabox is not None:
+            self.pandabox = None
+            release_pandabox(pandabox)
+
+    def AddDevice(self, axis):
+        # the connection is released with the last axis, get it back
+        if self.pandabox is None:
+            self.pandabox = get_pandabox(self.pandaboxhostname)
+        self._axes.add(axis)
+
+    def DeleteDevice(self, axis):
+        self._axes.discard(axis)
+        # the connection is shared with the other PandABox controllers
+        if not self._axes:
+            self.release()
+
+    def read_queued(self):
+        return self._queued.get(
+            lambda: float(self.pandabox.numquery(self._cmd["queued"])))
 
     @debug_it
     def StateOne(self, axis):
         try:
-            status_bit = self.pandabox.numquery("{}.QUEUED?".format(
-                self.trigger_block))
-            if float(status_bit) != 0:
-                state = tango.DevState.MOVING
-                status = "Triggering"
-            else:
-                state = tango.DevState.ON
-                status = "Standby"
-            return state, status
-        except Exception as e:
+            queued = self.read_queued()
+        except (socket.error, IOError) as e:
+            # not cached, the next StateOne asks again
+            self._log.error("Unable to read %s: %r", self._cmd["queued"], e)
             return tango.DevState.FAULT, "Panda Box is not responding."
+        if queued != 0:
+            state = tango.DevState.MOVING
+            status = "Triggering"
+        else:
+            state = tango.DevState.ON
+            status = "Standby"
+        return state, status
 
     @debug_it
     def PreStartOne(self, axis):
@@ -109,31 +162,21 @@ class PandaBoxTriggerGateCtrl(TriggerGateController):
     @handle_error(msg="Unable to configure_panda")
     def configure_panda(self, trigger_count, total, int_time):
         # set integration time to PULSE block
-        self.pandabox.query("{}.DELAY.UNITS=".format(
-            self.trigger_block) + "s")
-        self.pandabox.query("{}.WIDTH.UNITS=".format(
-            self.trigger_block) + "s")
-        self.pandabox.query("{}.STEP.UNITS=".format(
-            self.trigger_block) + "s")
-        self.pandabox.query("{}.ENABLE.DELAY=".format(
-            self.trigger_block) + "0")
-        self.pandabox.query("{}.TRIG.DELAY=".format(
-            self.trigger_block) + "0")
-        self.pandabox.query("{}.DELAY=".format(
-            self.trigger_block) + str(self.acq_delay))
-        self.pandabox.query("{}.PULSES=".format(
-            self.trigger_block) + str(trigger_count))
-        self.pandabox.query("{}.WIDTH=".format(
-            self.trigger_block) + str(int_time))
         # step = total = int_time + latency_time
-        # in pandabox = time between successive rising edges 
-        self.pandabox.query("{}.STEP=".format(
-            self.trigger_block) + str(total))
+        # in pandabox = time between successive rising edges
+        self.pandabox.query_many(self._units_cmds + [
+            self._cmd["delay"] + str(self.acq_delay),
+            self._cmd["pulses"] + str(trigger_count),
+            self._cmd["width"] + str(int_time),
+            self._cmd["step"] + str(total),
+        ])
 
     @debug_it
     @handle_error(msg="Error on enableBlocks")
     def enableBlocks(self, value):
-        self.pandabox.query("{}.ENABLE=".format(
-            self.trigger_block) + value)
-        self.pandabox.query("{}.TRIG=".format(
-            self.trigger_block) + value)
+        self.pandabox.query_many([
+            self._cmd["enable"] + value,
+            self._cmd["trig"] + value,
+        ])
+        # the blocks state has just changed, do not reuse the last answer
+        self._queued.invalidate()
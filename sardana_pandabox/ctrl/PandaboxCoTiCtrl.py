@@ -1,10 +1,17 @@
 #!/usr/bin/env python
-from pandaboxlib import PandA
+from __future__ import print_function
+from sardana_pandabox.pandabox import get_pandabox, release_pandabox, \
+    TimedCache
+import re
 import time
+import errno
 import socket
-from sockio.py2 import TCP 
-from StringIO import StringIO 
+import select
+import struct
+import weakref
+import threading
 import numpy as np 
+from collections import OrderedDict, deque
 
 from sardana import State, DataAccess
 from sardana.sardanavalue import SardanaValue
@@ -14,10 +21,54 @@ from sardana.pool.controller import CounterTimerController, Type, Access, \
 
 __all__ = ['PandaboxCoTiCtrl']
 
+
+def read_stream(ctrl_ref, data_socket, stop):
+    """Move the data stream of a controller to its stream buffer as soon
+    as it arrives, until stop is set or the stream fails."""
+    while not stop.is_set():
+        ctrl = ctrl_ref()
+        if ctrl is None:
+            return
+        try:
+            ctrl._RecvStream(data_socket)
+        except (socket.error, select.error, ValueError) as e:
+            ctrl._StreamFailed(data_socket, e)
+            return
+        del ctrl
+
 class PandaboxCoTiCtrl(CounterTimerController):
 
     MaxDevice = 28 # TODO remove this or check pandabox maximum number of channels
 
+    # data stream (port 8889) settings
+    _RECV_SIZE = 256 * 1024
+    _RCVBUF_SIZE = 8 * 1024 * 1024
+    _STREAM_TIMEOUT = 3
+    # longest wait of the stream reader thread before checking if it has
+    # to stop
+    _READER_PERIOD = 0.05
+    # bytes the reader thread keeps for the stream readers at most, above
+    # it the data stays in the kernel and TCP slows the PandABox down
+    _STREAM_BACKLOG = 32 * 1024 * 1024
+
+    # data stream options: binary frames of scaled values
+    _STREAM_OPTIONS = b'FRAMED SCALED\n'
+    # " name type capture ..." lines of the stream header
+    _FIELD_RE = re.compile(r'^ (\S+) (\S+)', re.M)
+    # wire type of the captured fields, as named in the stream header
+    _FIELD_TYPES = {'int32': '<i4', 'uint32': '<u4', 'int64': '<i8',
+                    'uint64': '<u8', 'double': '<f8'}
+
+    # seconds during which a StateAll answer is reused
+    _STATE_TTL = 0.005
+
+    # *PCAP.STATUS? answer tokens, the answer is "OK =Busy" or "OK =Idle"
+    _STATUS_RE = re.compile(r'Busy|Idle')
+    _STATUS_STATES = {'Busy': State.Moving, 'Idle': State.On}
+
+    # synchronizations where each acquisition is started by software
+    _SOFT_SYNCS = frozenset((AcqSynch.SoftwareTrigger, AcqSynch.SoftwareGate))
+
     ctrl_properties = {'PandaboxHost': {'Description': 'Pandabox Host name',
                                       'Type': 'PyTango.DevString'},
                        'PcapEnable': {'Description': 'Hardware trigger config: PCAP.ENABLE',
@@ -52,29 +103,16 @@ class PandaboxCoTiCtrl(CounterTimerController):
         self._log.debug("__init__(%s, %s): Entering...", repr(inst),
                         repr(props))
 
-        try:
-            self.pandabox = PandA(self.PandaboxHost)
-            self.pandabox.connect_to_panda()
-        except (NameError, socket.gaierror):
-            raise Exception('Unable to connect to PandABox.') 
-
-        # make sure PCAP block is reset
-        self.pandabox.query('PCAP.ENABLE=ZERO')
-        self.pandabox.query('*PCAP.DISARM=')
+        self.pandabox = None
+        self._stream_ready = threading.Event()
+        self._Connect()
 
-        try:
-            self.data_socket = TCP(self.PandaboxHost, 8889, timeout=3)
-            self.data_socket.open()
-        except:
-            raise Exception('Unable to open PandABox data stream.') 
- 
-        # check if data stream starts correctly
-        ack = self.data_socket.write_readline('\n')
-        if "OK" not in ack:
-            raise Exception('Acknowledge to data stream failed!') 
-        print "PandaboxCoTiCtrl: data stream listener starts...", ack
-        self.data_buffer = ""
+        self.data_buffer = bytearray()
         self.header_okay_flag = False
+        # parsed data rows of the current acquisition
+        self._table = np.empty((0, 0))
+        self._row_dtype = np.dtype([])
+        self._rows = 0
         self.data_end_flag = False 
 
         self.attributes = {}
@@ -84,6 +122,11 @@ class PandaboxCoTiCtrl(CounterTimerController):
         self.hw_trigger_cfg['trig'] = self.PcapTrig
 
         self.channels_order = []
+        # data column of each axis, built when the header is parsed
+        self._axis_to_col = {1: 0}
+        # capture mode of each channel, waiting to be sent on next
+        # StartAllCT; only the last mode set for a channel is sent
+        self._pending_capture = OrderedDict()
 
         # channels and modes available
         self._modes = ['Value','Diff','Min','Max','Sum','Mean']
@@ -99,10 +142,17 @@ class PandaboxCoTiCtrl(CounterTimerController):
 
         self.index = 0
         self._repetitions = 0
+        # software synchronized acquisition, updated by SetCtrlPar
+        self._is_sw = self._synchronization in self._SOFT_SYNCS
+        # last PCAP status answer, shared by back to back StateAll calls
+        self._state_cache = TimedCache(self._STATE_TTL)
 
     def AddDevice(self, axis):
         """Add device to controller."""
         self._log.debug("AddDevice(%d): Entering...", axis)
+        # the connections are released with the last axis, get them back
+        if self.pandabox is None:
+            self._Connect()
         self.attributes[axis-1] = {'ChannelName': None, 'AcquisitionMode':'Value'}
         # count buffer for the continuous scan
         if axis != 1:
@@ -111,26 +161,127 @@ class PandaboxCoTiCtrl(CounterTimerController):
     def DeleteDevice(self, axis):
         """Delete device from the controller."""
         self._log.debug("DeleteDevice(%d): Entering...", axis)
-        self.data_socket.close()
-        self.pandabox.disconnect_from_panda()
+        self.attributes.pop(axis-1, None)
+        # the connections are shared by all the axes
+        if not self.attributes:
+            self._Release()
+
+    def __del__(self):
+        self._Release()
+
+    def _Release(self):
+        """Stop the data stream and release the PandABox connection.
+
+        Only the first call does something, it is safe to call on a
+        partially initialized controller.
+        """
+        pandabox = getattr(self, "pandabox", None)
+        if pandabox is None:
+            return
+        self.pandabox = None
+        self._CloseDataStream()
+        release_pandabox(pandabox)
+
+    def _CloseDataStream(self):
+        """Stop the reader thread and close the data stream."""
+        stop_reading = getattr(self, "_stop_reading", None)
+        if stop_reading is not None:
+            stop_reading.set()
+        data_socket = getattr(self, "data_socket", None)
+        if data_socket is not None:
+            data_socket.close()
+
+    def _Connect(self):
+        """Get the PandABox connection and open the data stream."""
+        try:
+            self.pandabox = get_pandabox(self.PandaboxHost)
+        except (NameError, socket.gaierror):
+            raise Exception('Unable to connect to PandABox.') 
+        try:
+            # make sure PCAP block is reset
+            self.pandabox.query_many(['PCAP.ENABLE=ZERO', '*PCAP.DISARM='])
+            self._OpenDataStream()
+        except Exception:
+            # do not keep the shared connection busy for nothing
+            self._Release()
+            raise
+
+    def _OpenDataStream(self):
+        """Connect the data stream and start its reader thread."""
+        # chunks received by the reader thread, handed over without a lock:
+        # only the reader appends and only the stream readers pop, then
+        # set _stream_ready to wake them up
+        self._stream_chunks = deque()
+        # bytes appended (reader thread) and popped (stream readers), each
+        # counter has a single writer
+        self._stream_received = 0
+        self._stream_taken = 0
+        self._stream_error = None
+        # bytes of the data stream moved from the chunks and not consumed
+        # yet, only touched by the stream readers
+        self._stream_buffer = bytearray()
+        # the data stream socket is kept open for the controller lifetime
+        # and reused by every acquisition
+        try:
+            self.data_socket = self._ConnectDataSocket()
+            self.data_socket.setblocking(0)
+        except socket.error:
+            raise Exception('Unable to open PandABox data stream.') 
+
+        # the stream is drained as it arrives, not only when sardana
+        # polls, so the PandABox is never slowed down by a full TCP window
+        self._stop_reading = threading.Event()
+        self._reader = threading.Thread(
+            target=read_stream,
+            args=(weakref.ref(self), self.data_socket, self._stop_reading))
+        self._reader.daemon = True
+        self._reader.start()
+ 
+        # check if data stream starts correctly
+        self.data_socket.sendall(self._STREAM_OPTIONS)
+        ack = self._ReadStreamLines(1)[0]
+        if "OK" not in ack:
+            raise Exception('Acknowledge to data stream failed!') 
+        self._log.debug("Data stream listener starts... %s", ack)
+
+    def _ConnectDataSocket(self):
+        """Return a socket connected to the PandABox data port."""
+        data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            data_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            data_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # set before connecting so the TCP window can make use of it
+            data_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                   self._RCVBUF_SIZE)
+            data_socket.settimeout(self._STREAM_TIMEOUT)
+            data_socket.connect((self.PandaboxHost, 8889))
+        except socket.error:
+            data_socket.close()
+            raise
+        return data_socket
 
     def StateAll(self):
         """Read state of all axis."""
         # self._log.debug("StateAll(): Entering...")
-        state = self.pandabox.query('*PCAP.STATUS?')
+        self._state_cache.get(self._ReadState)
 
-        if "Busy" in state:
-            self.state = State.Moving
-        elif "Idle" in state:
-            self.state = State.On
-        elif "OK" not in state:
-            self.state = State.Fault
+    def _ReadState(self):
+        """Query the PCAP status, update state and status and return it."""
+        # the raw answer line, ERR included, is classified below
+        state = self.pandabox.query_many(['*PCAP.STATUS?'])[0]
+
+        # single scan of the answer, dispatched on the recognized token
+        match = self._STATUS_RE.search(state)
+        if match:
+            self.state = self._STATUS_STATES[match.group()]
         else:
             self.state = State.Fault
-            self._log.debug("StateAll(): %r %r UNKNWON STATE: %s" % (
-                self.state, self.status), state)
+            if "OK" in state:
+                self._log.debug("StateAll(): %r UNKNWON STATE: %s",
+                                self.state, state)
         self.status = state
         # self._log.debug("StateAll(): %r %r" %(self.state, self.status))
+        return state
 
     def StateOne(self, axis):
         """Read state of one axis."""
@@ -143,29 +294,35 @@ class PandaboxCoTiCtrl(CounterTimerController):
         if axis != 1:
             raise Exception('The master channel should be the axis 1')
 
+        # a data stream lost since the last acquisition is opened again,
+        # failing here rather than acquiring no data
+        if self._stream_error is not None or not self._reader.is_alive():
+            self._log.warning("PandABox data stream lost (%s), reopening it",
+                              self._stream_error)
+            self._CloseDataStream()
+            self._OpenDataStream()
+
         self.itime = value
         self.index = 0 
 
         # Set Integration time in s per point
-        self.pandabox.query('PULSE1.WIDTH.UNITS=s')
         if value < 8e-08:   # minimum reliable integration time is
                             # 10 FPGA clock ticks 125 MHz -> 80 ns 
             self._log.debug("The minimum integration time is 80 ns")
             value = 8e-08
-        self.pandabox.query('PULSE1.WIDTH=%.9f' % (value))
+        cmds = ['PULSE1.WIDTH.UNITS=s', 'PULSE1.WIDTH=%.9f' % (value)]
 
         # Set falling edge capture to have
         # "gate signal that marks the capture boundaries"
         # in order to respect the integration time
         # see PCAP block documentation
-        self.pandabox.query('PCAP.TRIG_EDGE=Falling')
+        cmds.append('PCAP.TRIG_EDGE=Falling')
 
-        if self._synchronization in [AcqSynch.SoftwareTrigger,
-                                     AcqSynch.SoftwareGate]:
+        if self._is_sw:
             # self._log.debug("SetCtrlPar(): setting synchronization "
             #                 "to SoftwareTrigger")
             self._repetitions = 1
-            self.pandabox.query('PULSE1.PULSES=1')
+            cmds.append('PULSE1.PULSES=1')
 
             # link blocks for software acquisition
             trig = 'PULSE1.OUT'
@@ -178,14 +335,23 @@ class PandaboxCoTiCtrl(CounterTimerController):
 
         # create links to PCAP block
         # TODO: separate gated mode? 
-        #self.pandabox.query('PCAP.GATE=ONE')
-        self.pandabox.query('PCAP.GATE='+trig)
-        self.pandabox.query('PCAP.TRIG='+trig)
+        #cmds.append('PCAP.GATE=ONE')
+        cmds.append('PCAP.GATE='+trig)
+        cmds.append('PCAP.TRIG='+trig)
+        # all the configuration goes in a single round-trip
+        self.pandabox.query_many(cmds)
         
         # reset data buffer and header flag
         self.header_okay_flag = False
         self.data_end_flag = False 
-        self.data_buffer = '' 
+        self.data_buffer = bytearray()
+        # drop what is left from a previous acquisition
+        self._TakeStream()
+        self._stream_buffer = bytearray()
+        # the data table is allocated when the header is parsed
+        self._table = np.empty((0, 0))
+        self._row_dtype = np.dtype([])
+        self._rows = 0
 
     def PreStartOneCT(self, axis):
         # self._log.debug("PreStartOneCT(%d): Entering...", axis)
@@ -199,83 +365,96 @@ class PandaboxCoTiCtrl(CounterTimerController):
         PreStartOneCT for master channel.
         """
         # self._log.debug("StartAllCT(): Entering...")
-        ret = self.pandabox.query('*PCAP.ARM=')
-        if "OK" not in ret:
-            print "Pandabox arm PCAP failed. Disarm and arm again..."
-            ret = self.pandabox.query('*PCAP.DISARM=')
-            ret = self.pandabox.query('*PCAP.ARM=')
-
-        # start acquisition by enabling PCAP
-        self.pandabox.query('PCAP.ENABLE=ONE')
-
-        # trig acquisition
-        if self._synchronization in [AcqSynch.SoftwareTrigger,
-                                     AcqSynch.SoftwareGate]:
-            self.pandabox.query('PULSE1.ENABLE=ONE') # make sure block is enabled
-            self.pandabox.query('PULSE1.TRIG=ZERO')
-            self.pandabox.query('PULSE1.TRIG=ONE')
+        # arm, start acquisition by enabling PCAP and, in software mode,
+        # trig acquisition, all in a single round-trip
+        cmds = ['*PCAP.ARM=', 'PCAP.ENABLE=ONE']
+        if self._is_sw:
+            cmds += ['PULSE1.ENABLE=ONE', # make sure block is enabled
+                     'PULSE1.TRIG=ZERO',
+                     'PULSE1.TRIG=ONE']
         # else wait for triggers (hardware mode)
+        # channel capture changes are flushed in the same round-trip
+        pending = ['%s.CAPTURE=%s' % item
+                   for item in self._pending_capture.items()]
+        self._pending_capture = OrderedDict()
+        ret = self.pandabox.query_many(pending + cmds)[len(pending)]
+        if "OK" not in ret:
+            self._log.warning("Arm PCAP failed (%s). Disarm and arm "
+                              "again...", ret)
+            # the rest of the batch already ran: bring PCAP.ENABLE back to
+            # ZERO so it gets a rising edge again once PCAP is re-armed
+            self.pandabox.query_many(['PCAP.ENABLE=ZERO',
+                                      '*PCAP.DISARM='] + cmds)
 
         # THIS PROTECTION HAS TO BE REVIEWED
         # FAST INTEGRATION TIMES MAY RAISE WRONG EXCEPTIONS
         # e.g. 10ms ACQTIME -> self.state MAY BE NOT MOVING BECAUSE
         # FINISHED, NOT FAILED
-        self.StateAll()
+        # poll with an exponential back-off (200 us up to 5 ms) instead of
+        # flooding the control socket with status queries
+        # the state is read directly, not through the StateAll cache
+        self._ReadState()
         t0 = time.time()
+        retry = 0
         while (self.state != State.Moving):
             if time.time() - t0 > 3:
                 raise Exception('The HW did not start the acquisition')
-            self.StateAll()
+            time.sleep(min(0.005, 2e-4 * 2**retry))
+            retry += 1
+            self._ReadState()
+        self._state_cache.set(self.status)
         return True
 
     def ReadAll(self):
         # self._log.debug("ReadAll(): Entering...")
-        self.data_ready = int(self.pandabox.numquery('*PCAP.CAPTURED?'))
-        #print "Points acquired: %d"%self.data_ready
-
         self.new_data = [] 
         #self.index = 0 
 
-        if self.data_ready == 0:
-            print "Pandabox: No data available yet."
-            self._ParseHeader()
-            return
-        elif self.data_ready <= self._repetitions:
-            if self.data_ready == self._repetitions:
-                print "Pandabox data acquisition has finished, disabling PCAP..."
+        # the rows decoded from the data stream tell how many points were
+        # acquired, no need to ask the pandabox
+        # make sure the header is consumed before reading data rows
+        self._ParseHeader()
+        # a stream error fails the acquisition, the stream is reopened by
+        # the next LoadOne
+        try:
+            if self.header_okay_flag and not self.data_end_flag:
+                self._ReadDataStream()
+        except socket.error as e:
+            self._log.error("Data stream error: %s", e)
+            raise
+
+        # only the rows received since the last call are decoded,
+        # they are stored in the table allocated for this acquisition
+        row_size = self._row_dtype.itemsize
+        nrows = 0
+        if row_size:
+            nrows = min(len(self.data_buffer) // row_size,
+                        len(self._table) - self._rows)
+        if nrows > 0:
+            rows = np.frombuffer(self.data_buffer, dtype=self._row_dtype,
+                                 count=nrows)
+            table = self._table[self._rows:self._rows+nrows]
+            for col, field in enumerate(self._row_dtype.names, 1):
+                table[:, col] = rows[field]
+            # release the view before resizing the buffer
+            del rows
+            del self.data_buffer[:nrows*row_size]
+            self._rows += nrows
+            if self._rows == self._repetitions:
+                self._log.debug("Data acquisition has finished, "
+                                "disabling PCAP...")
                 self.pandabox.query('PCAP.ENABLE=ZERO') # it disarms PCAP too
-            try:
-                if not self.data_end_flag:
-                    data = self.data_socket.readline()
-                    if 'END' not in data:
-                        self.data_buffer += data
-                    else:
-                        print "Pandabox data acquisition ENDs okay!"
-                        self.data_end_flag = True 
-            except socket.error, e:
-                print "Pandabox: data socket error: ", e
-                self.data_socket.close()
-
-            data_only = np.genfromtxt(StringIO(self.data_buffer), dtype='float64')
-
-            # TODO: hw scan mode fails with int time < 100 ms
-            # we have only one line per execution of this method, fix it
-            if data_only.ndim > 1: # crop to get only new data
-                data_only = data_only[self.index:self.data_ready+1]
-
-            if self.index <= self.data_ready:   # mandatory to avoid extra lines
-                self.new_data = np.ndarray.tolist(data_only.transpose())
-                if type(self.new_data[0]) != list:
-                    one_line_data = []
-                    for value in self.new_data:
-                        one_line_data.append([value])
-                    self.new_data = one_line_data 
-    
-                time_data = [self.itime] * len(self.new_data[0])
-                self.new_data.insert(0, time_data)
-                
-                if self._repetitions != 1:
-                    self.index += len(time_data)
+        self.data_ready = self._rows
+        #print("Points acquired: %d"%self.data_ready)
+
+        if self._rows == 0:
+            self._log.debug("No data available yet.")
+            return
+        # rows decoded but not handed to sardana yet, as a view of the
+        # table with one row per channel, the timer first
+        self.new_data = self._table[self.index:self._rows].T
+        if self._repetitions != 1:
+            self.index = self._rows
 
 
     def ReadOne(self, axis):
@@ -284,31 +463,26 @@ class PandaboxCoTiCtrl(CounterTimerController):
             #return -1 
             return None 
 
-        if axis == 1:    # timer axis
-            channel_index = 0
-        else:
-            channel_name = str(self.attributes[axis-1]['ChannelName'])
-            if channel_name not in self.channels_order:
-                raise ValueError('Channel name configured is not enabled in pandabox')
-            else:
-                channel_index = (self.channels_order.index(channel_name) + 1) # +1 because of timer column
-            
-        if self._synchronization in [AcqSynch.SoftwareTrigger,
-                                     AcqSynch.SoftwareGate]:
-            return SardanaValue(self.new_data[channel_index][0])
+        channel_index = self._axis_to_col.get(axis)
+        if channel_index is None:
+            raise ValueError('Channel name configured is not enabled in pandabox')
+
+        if self._is_sw:
+            return SardanaValue(float(self.new_data[channel_index, 0]))
 
         else:
-            val = self.new_data[channel_index]
-            return val
+            # sardana expects a list of values
+            return self.new_data[channel_index].tolist()
 
     def AbortOne(self, axis):
         # self._log.debug("AbortOne(%d): Entering...", axis)
         self.pandabox.query('*PCAP.DISARM=')
+        self._state_cache.invalidate()
 
     def StopOne(self, axis):
         # self._log.debug("StopOne(%d): Entering...", axis)
-        self.pandabox.query('PCAP.ENABLE=ZERO')
-        self.pandabox.query('*PCAP.DISARM=')
+        self.pandabox.query_many(['PCAP.ENABLE=ZERO', '*PCAP.DISARM='])
+        self._state_cache.invalidate()
 
     def _ParseHeader(self):
         if not self.header_okay_flag:
@@ -316,32 +490,190 @@ class PandaboxCoTiCtrl(CounterTimerController):
             # HEADER FORMAT:
             # missed: 0
             # process: Scaled
-            # format: ASCII
+            # format: Framed
             # fields:
-            #  + one line per channel enabled
+            #  + one line per channel enabled: name type capture ...
+            #  + blank line
+            # the blank line delimits the header, no need to ask the
+            # pandabox how many channels are enabled
             fixed_header_lines = 4 
-            num_channels_enabled = self.pandabox.get_number_channels()
-            num_lines = fixed_header_lines+num_channels_enabled
     
-            data_header = ""
+            data_header = []
+            fields_text = ''
             try:
-                data_header = self.data_socket.readlines(num_lines+1) #+1 blank line
-                if "fields" in data_header[3]:
-                    print "Pandabox data header parsing okay!"
+                data_header = self._ReadStreamHeader().split(
+                    '\n', fixed_header_lines)
+                if len(data_header) > fixed_header_lines and \
+                        "fields" in data_header[3]:
+                    fields_text = data_header[fixed_header_lines]
+                    self._log.debug("Data header parsing okay!")
                     self.header_okay_flag = True 
-            except socket.error, e:
-                print "Pandabox: socket error header!!!! = ", e
+            except socket.timeout:
+                # no header yet, it is waited for again by the next ReadAll
+                self._log.debug("Data header not received yet")
                 self.header_okay_flag = False
-                pass 
+            except socket.error as e:
+                self._log.error("Data stream error reading header: %s", e)
+                raise
     
-            channels_list = data_header[fixed_header_lines:fixed_header_lines+num_channels_enabled]
-            self.channels_order = []
-            for channel in channels_list:
-                channel = channel.split(' ')[1:2]
-                self.channels_order.append(channel[0])
-            #print "Channels order: ", self.channels_order
+            # (name, type) of every field in a single regex pass
+            channels_list = self._FIELD_RE.findall(fields_text)
+            self.channels_order = [name for name, _ in channels_list]
+            fields = [('f%d' % i, self._FIELD_TYPES[field_type])
+                      for i, (_, field_type) in enumerate(channels_list)]
+            #print("Channels order: ", self.channels_order)
+            # layout of one binary sample
+            self._row_dtype = np.dtype(fields)
+
+            # one allocation per acquisition, filled as rows arrive;
+            # the first column is the timer, constant during the acquisition
+            self._table = np.empty((self._repetitions,
+                                    len(self.channels_order) + 1),
+                                   dtype=np.float64)
+            self._table[:, 0] = self.itime
+            self._rows = 0
+
+            # resolve once per acquisition the data column of every axis
+            # +1 because of timer column
+            channel_idx = dict((name, i+1) for i, name
+                               in enumerate(self.channels_order))
+            self._axis_to_col = {1: 0}    # timer axis
+            for idx, attrs in self.attributes.items():
+                col = channel_idx.get(attrs['ChannelName'])
+                if col is not None:
+                    self._axis_to_col[idx+1] = col
         return
 
+    def _RecvStream(self, data_socket):
+        """Move the bytes pending on the data socket to the stream chunks.
+
+        Called by the reader thread: wait up to _READER_PERIOD for data,
+        then drain the bytes already queued in the kernel with as few
+        large recv calls as possible and wake up the stream readers.
+        Nothing is read while _STREAM_BACKLOG bytes are waiting for the
+        stream readers.
+        """
+        if self._StreamBacklog() >= self._STREAM_BACKLOG:
+            time.sleep(self._READER_PERIOD)
+            return 0
+        readable, _, _ = select.select([data_socket], [], [],
+                                       self._READER_PERIOD)
+        if not readable:
+            return 0
+        # bound once, this loop runs for every chunk of the stream
+        recv = data_socket.recv
+        append = self._stream_chunks.append
+        received = 0
+        try:
+            while self._StreamBacklog() < self._STREAM_BACKLOG:
+                try:
+                    chunk = recv(self._RECV_SIZE)
+                except socket.error as e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    raise
+                if not chunk:
+                    raise socket.error('PandABox closed the data stream')
+                append(chunk)
+                self._stream_received += len(chunk)
+                received += len(chunk)
+        finally:
+            if received:
+                self._stream_ready.set()
+        return received
+
+    def _StreamBacklog(self):
+        """Return the bytes received and not taken by the stream readers."""
+        return self._stream_received - self._stream_taken
+
+    def _StreamFailed(self, data_socket, error):
+        """Record the error that stopped the reader thread, it is raised
+        by the next stream read."""
+        # a reader stopped with its socket closed, the stream is reopened
+        if data_socket is not self.data_socket:
+            return
+        self._stream_error = error
+        self._stream_ready.set()
+
+    def _TakeStream(self):
+        """Move the chunks received so far to the stream buffer."""
+        popleft = self._stream_chunks.popleft
+        extend = self._stream_buffer.extend
+        taken = 0
+        while True:
+            try:
+                chunk = popleft()
+            except IndexError:
+                break
+            extend(chunk)
+            taken += len(chunk)
+        self._stream_taken += taken
+
+    def _WaitStream(self, ready):
+        """Take the received chunks until ready() is true."""
+        deadline = time.time() + self._STREAM_TIMEOUT
+        while True:
+            # cleared before taking: a chunk appended meanwhile sets it
+            # again, so it is never waited for
+            self._stream_ready.clear()
+            self._TakeStream()
+            if ready():
+                return
+            if self._stream_error is not None:
+                raise self._stream_error
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout('PandABox data stream timed out')
+            self._stream_ready.wait(remaining)
+
+    def _ReadStreamLines(self, num_lines):
+        """Return the next num_lines lines of the data stream."""
+        buf = self._stream_buffer
+        self._WaitStream(lambda: buf.count(b'\n') >= num_lines)
+        lines = buf.split(b'\n', num_lines)
+        del buf[:len(buf) - len(lines.pop())]
+        return [bytes(line).decode() for line in lines]
+
+    def _ReadStreamHeader(self):
+        """Return the text of the next stream header, without the blank
+        line that ends it."""
+        buf = self._stream_buffer
+        self._WaitStream(lambda: b'\n\n' in buf)
+        end = buf.find(b'\n\n')
+        header = bytes(buf[:end]).decode()
+        del buf[:end+2]
+        return header
+
+    def _ReadDataStream(self):
+        """Append the payload of every complete frame to data_buffer.
+
+        Data comes in "BIN " frames: a 4 bytes little endian length of the
+        whole frame, header included, then the binary samples (a sample
+        can be split across frames). The acquisition ends with an
+        "END ..." text line.
+        """
+        self._TakeStream()
+        buf = self._stream_buffer
+        while True:
+            if buf.startswith(b'BIN '):
+                if len(buf) < 8:
+                    break
+                length = struct.unpack_from('<I', buf, 4)[0]
+                if len(buf) < length:
+                    break
+                self.data_buffer.extend(buf[8:length])
+                del buf[:length]
+            elif buf.startswith(b'END ') and b'\n' in buf:
+                self._log.debug("Data acquisition ENDs okay!")
+                self.data_end_flag = True
+                del buf[:buf.index(b'\n')+1]
+                break
+            else:
+                break
+        # what was received before a failure is still returned
+        if not self.data_end_flag and self._stream_error is not None:
+            raise self._stream_error
+
 ###############################################################################
 #                Axis Extra Attribute Methods
 ###############################################################################
@@ -371,12 +703,13 @@ class PandaboxCoTiCtrl(CounterTimerController):
                 raise Exception(error_msg)
         else:
             # first disable previous channel
+            # the commands are sent to the pandabox by StartAllCT
             if self.attributes[axis]['ChannelName'] is not None:
-                cmd = self.attributes[axis]['ChannelName'] + '.CAPTURE=No'
-                self.pandabox.query(cmd)
+                self._pending_capture[self.attributes[axis]['ChannelName']] = 'No'
             self.attributes[axis][name] = value
-            cmd = self.attributes[axis]['ChannelName'] + '.CAPTURE=' + self.attributes[axis]['AcquisitionMode']
-            self.pandabox.query(cmd)
+            # a mode set before the channel is sent with the channel
+            if self.attributes[axis]['ChannelName'] is not None:
+                self._pending_capture[self.attributes[axis]['ChannelName']] = self.attributes[axis]['AcquisitionMode']
         
 
 ###############################################################################
@@ -385,6 +718,8 @@ class PandaboxCoTiCtrl(CounterTimerController):
     # MANDATORY implement it to have self._synchronization
     def SetCtrlPar(self, parameter, value):
         CounterTimerController.SetCtrlPar(self, parameter, value)
+        if parameter == 'synchronization':
+            self._is_sw = value in self._SOFT_SYNCS
 
     def GetCtrlPar(self, parameter):
         value = CounterTimerController.GetCtrlPar(self, parameter)
@@ -405,8 +740,8 @@ if __name__ == '__main__':
     #ctrl.AddDevice(5)
 
     acqtime = 0.5
-    ctrl._synchronization = AcqSynch.SoftwareTrigger
-    #ctrl._synchronization = AcqSynch.HardwareTrigger
+    ctrl.SetCtrlPar('synchronization', AcqSynch.SoftwareTrigger)
+    #ctrl.SetCtrlPar('synchronization', AcqSynch.HardwareTrigger)
     if ctrl._synchronization == AcqSynch.SoftwareTrigger:
         repetitions = 1
     else:
@@ -419,8 +754,8 @@ if __name__ == '__main__':
         ctrl.StateAll()
         ctrl.ReadAll()
         time.sleep(0.25)
-    print "Time: ", time.time() - t0 - acqtime
-    print "COUNTER1.OUT = ", ctrl.ReadOne(2)
-    print "INENC1.VAL = ", ctrl.ReadOne(3)
+    print("Time: ", time.time() - t0 - acqtime)
+    print("COUNTER1.OUT = ", ctrl.ReadOne(2))
+    print("INENC1.VAL = ", ctrl.ReadOne(3))
 
 
@@ -0,0 +1,135 @@
+"""Helpers shared by the PandABox Sardana controllers."""
+
+import socket
+import threading
+import time
+
+from pandaboxlib import PandA
+
+# connections shared by all the controllers of the same PandABox
+_PANDA_POOL = {}
+_PANDA_POOL_LOCK = threading.Lock()
+
+
+def get_pandabox(host):
+    """Return the connected PandABox for host, opening it on first use.
+
+    Every call must be paired with a release_pandabox call.
+    """
+    with _PANDA_POOL_LOCK:
+        pandabox = _PANDA_POOL.get(host)
+        if pandabox is None:
+            pandabox = PandABox(host)
+            pandabox.connect_to_panda()
+            _PANDA_POOL[host] = pandabox
+        pandabox.users += 1
+        return pandabox
+
+
+def release_pandabox(pandabox):
+    """Drop one user of pandabox, disconnecting it after the last one."""
+    with _PANDA_POOL_LOCK:
+        pandabox.users -= 1
+        if pandabox.users > 0:
+            return
+        if _PANDA_POOL.get(pandabox.host) is pandabox:
+            del _PANDA_POOL[pandabox.host]
+    pandabox.disconnect_from_panda()
+
+
+class TimedCache(object):
+    """Value read again only when the last read is older than ttl seconds.
+
+    Failed reads are not cached. The reading callable is passed on every
+    get, so the cache does not hold a reference to its owner.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.value = None
+        self._ts = 0.0
+
+    def get(self, read):
+        now = time.time()
+        if now - self._ts >= self.ttl:
+            self.value = read()
+            self._ts = now
+        return self.value
+
+    def set(self, value):
+        self.value = value
+        self._ts = time.time()
+
+    def invalidate(self):
+        self._ts = 0.0
+
+
+class PandABox(PandA):
+    """
+    PandA client able to pipeline several commands in one round-trip.
+
+    It can be shared between threads and controllers: every exchange on
+    the control socket is serialized by a lock.
+    """
+
+    RX_BUFFER_SIZE = 4096
+
+    def __init__(self, host, *args, **kwargs):
+        PandA.__init__(self, host, *args, **kwargs)
+        self.host = host
+        self.users = 0
+        self._lock = threading.RLock()
+        # responses are received in place, without a per-call allocation
+        self._rxbuf = bytearray(self.RX_BUFFER_SIZE)
+        self._rxview = memoryview(self._rxbuf)
+
+    def connect_to_panda(self):
+        PandA.connect_to_panda(self)
+        # commands are tiny, do not let Nagle hold them back
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # the connection lives as long as its controllers, detect if the
+        # PandABox goes away while it is idle
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+    def query(self, cmd):
+        with self._lock:
+            return PandA.query(self, cmd)
+
+    def numquery(self, cmd):
+        with self._lock:
+            return PandA.numquery(self, cmd)
+
+    def query_many(self, cmds):
+        """Send all cmds in one write and return their responses in order.
+
+        The PandA control server answers each command with one line ("OK",
+        "OK =value" or "ERR ...") or, for multi-line answers, with "!"
+        prefixed lines terminated by ".". Those are returned as a list of
+        lines without the prefix.
+        """
+        if not cmds:
+            return []
+        with self._lock:
+            self.sock.sendall(("\n".join(cmds) + "\n").encode())
+            return self._recv_responses(len(cmds))
+
+    def _recv_responses(self, count):
+        responses = []
+        multiline = []
+        pending = b""
+        while len(responses) < count:
+            nbytes = self.sock.recv_into(self._rxview)
+            if not nbytes:
+                raise IOError("PandABox closed the control connection")
+            lines = (pending + self._rxview[:nbytes].tobytes()).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                line = line.decode()
+                if line.startswith("!"):
+                    multiline.append(line[1:])
+                elif line == ".":
+                    responses.append(multiline)
+                    multiline = []
+                else:
+                    responses.append(line)
+        return responses
@@ -0,0 +1,33 @@
+"""Test doubles of the PandABox connections."""
+
+
+class FakePandA(object):
+    """Control connection answering "OK" unless told otherwise.
+
+    answers maps a command to its answer, or to a list of answers used
+    one per call.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.sent = []
+        self.batches = []
+        self.answers = {"*PCAP.STATUS?": "OK =Busy"}
+        self.users = 1
+
+    def query_many(self, cmds):
+        self.batches.append(list(cmds))
+        self.sent.extend(cmds)
+        return [self._answer(cmd) for cmd in cmds]
+
+    def query(self, cmd):
+        return self.query_many([cmd])[0]
+
+    def numquery(self, cmd):
+        return float(self.query(cmd).split("=", 1)[1])
+
+    def _answer(self, cmd):
+        answer = self.answers.get(cmd, "OK")
+        if isinstance(answer, list):
+            return answer.pop(0) if len(answer) > 1 else answer[0]
+        return answer
@@ -0,0 +1,330 @@
+"""Tests of PandaboxCoTiCtrl against a fake PandABox."""
+
+import socket
+import struct
+import time
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("sardana")
+pytest.importorskip("pandaboxlib")
+
+from sardana import State  # noqa: E402
+from sardana.pool import AcqSynch  # noqa: E402
+from sardana.sardanavalue import SardanaValue  # noqa: E402
+
+from sardana_pandabox.ctrl import PandaboxCoTiCtrl as coti  # noqa: E402
+
+from fakes import FakePandA  # noqa: E402
+
+PROPS = {"PandaboxHost": "pandabox", "PcapEnable": "ONE",
+         "PcapGate": "ONE", "PcapTrig": "TTLIN1.VAL"}
+
+# one sample: a double and an int32 field
+SAMPLE = np.dtype([("f0", "<f8"), ("f1", "<i4")])
+HEADER = (b"missed: 0\nprocess: Scaled\nformat: Framed\nfields:\n"
+          b" COUNTER1.OUT double Value\n INENC1.VAL int32 Value\n\n")
+
+
+class FakeBox(object):
+    """Connections handed to the controllers, and their far ends."""
+
+    def __init__(self, monkeypatch):
+        self.pandaboxes = []
+        self.streams = []
+        self.ctrls = []
+        monkeypatch.setattr(coti, "get_pandabox", self.get_pandabox)
+        monkeypatch.setattr(coti, "release_pandabox", self.release_pandabox)
+        monkeypatch.setattr(coti.PandaboxCoTiCtrl, "_ConnectDataSocket",
+                            lambda ctrl: self.connect_data())
+
+    def get_pandabox(self, host):
+        pandabox = FakePandA(host)
+        self.pandaboxes.append(pandabox)
+        return pandabox
+
+    def release_pandabox(self, pandabox):
+        pandabox.users -= 1
+
+    def connect_data(self):
+        ctrl_end, panda_end = socket.socketpair()
+        panda_end.sendall(b"OK\n")
+        self.streams.append(panda_end)
+        return ctrl_end
+
+    @property
+    def pandabox(self):
+        return self.pandaboxes[-1]
+
+    @property
+    def stream(self):
+        return self.streams[-1]
+
+    def ctrl(self, axes=(1, 2, 3)):
+        ctrl = coti.PandaboxCoTiCtrl("pandabox_ctrl", dict(PROPS))
+        self.ctrls.append(ctrl)
+        for axis in axes:
+            ctrl.AddDevice(axis)
+        return ctrl
+
+    def close(self):
+        for ctrl in self.ctrls:
+            ctrl._Release()
+        for stream in self.streams:
+            stream.close()
+
+
+@pytest.fixture
+def box(monkeypatch):
+    box = FakeBox(monkeypatch)
+    yield box
+    box.close()
+
+
+def samples(count):
+    data = np.zeros(count, dtype=SAMPLE)
+    data["f0"] = np.arange(count) * 1.5
+    data["f1"] = np.arange(count) * 10
+    return data.tobytes()
+
+
+def frame(payload):
+    return b"BIN " + struct.pack("<I", len(payload) + 8) + payload
+
+
+def feed(ctrl, stream, data):
+    """Send data on the stream and wait for the reader thread to get it."""
+    expected = ctrl._stream_received + len(data)
+    stream.sendall(data)
+    deadline = time.time() + 2
+    while ctrl._stream_received < expected:
+        assert time.time() < deadline, "reader thread did not get the data"
+        time.sleep(0.001)
+
+
+def hardware_ctrl(box, repetitions=3):
+    ctrl = box.ctrl()
+    ctrl.SetExtraAttributePar(2, "ChannelName", "COUNTER1.OUT")
+    ctrl.SetExtraAttributePar(3, "ChannelName", "INENC1.VAL")
+    ctrl.SetCtrlPar("synchronization", AcqSynch.HardwareTrigger)
+    ctrl.LoadOne(1, 0.1, repetitions)
+    return ctrl
+
+
+def test_init_opens_data_stream(box):
+    ctrl = box.ctrl()
+    assert box.pandabox.sent == ["PCAP.ENABLE=ZERO", "*PCAP.DISARM="]
+    assert box.stream.recv(1024) == b"FRAMED SCALED\n"
+    assert ctrl._reader.is_alive()
+
+
+def test_sample_split_across_frames(box):
+    ctrl = hardware_ctrl(box)
+    raw = samples(2)
+    feed(ctrl, box.stream, frame(raw[:17]) + frame(raw[17:]))
+    ctrl._ReadDataStream()
+    assert bytes(ctrl.data_buffer) == raw
+    assert not ctrl._stream_buffer
+
+
+def test_partial_frame_header(box):
+    ctrl = hardware_ctrl(box)
+    raw = samples(1)
+    data = frame(raw)
+    feed(ctrl, box.stream, data[:6])
+    ctrl._ReadDataStream()
+    assert not ctrl.data_buffer
+    assert bytes(ctrl._stream_buffer) == data[:6]
+    feed(ctrl, box.stream, data[6:])
+    ctrl._ReadDataStream()
+    assert bytes(ctrl.data_buffer) == raw
+    assert not ctrl._stream_buffer
+
+
+def test_partial_frame_payload(box):
+    ctrl = hardware_ctrl(box)
+    raw = samples(3)
+    data = frame(raw)
+    feed(ctrl, box.stream, data[:20])
+    ctrl._ReadDataStream()
+    assert not ctrl.data_buffer
+    feed(ctrl, box.stream, data[20:])
+    ctrl._ReadDataStream()
+    assert bytes(ctrl.data_buffer) == raw
+
+
+def test_end_in_later_chunk(box):
+    ctrl = hardware_ctrl(box)
+    raw = samples(2)
+    feed(ctrl, box.stream, frame(raw))
+    ctrl._ReadDataStream()
+    assert bytes(ctrl.data_buffer) == raw
+    assert not ctrl.data_end_flag
+    feed(ctrl, box.stream, b"END 2 ")
+    ctrl._ReadDataStream()
+    assert not ctrl.data_end_flag
+    feed(ctrl, box.stream, b"Ok\n")
+    ctrl._ReadDataStream()
+    assert ctrl.data_end_flag
+    assert not ctrl._stream_buffer
+    assert ctrl._StreamBacklog() == 0
+
+
+def test_header_table_read_one(box):
+    ctrl = hardware_ctrl(box)
+    raw = samples(3)
+    feed(ctrl, box.stream, HEADER + frame(raw[:20]))
+    ctrl.ReadAll()
+    assert ctrl.channels_order == ["COUNTER1.OUT", "INENC1.VAL"]
+    assert ctrl._row_dtype == SAMPLE
+    assert ctrl._axis_to_col == {1: 0, 2: 1, 3: 2}
+    assert ctrl._table.shape == (3, 3)
+    assert ctrl.ReadOne(1) == [0.1]
+    assert ctrl.ReadOne(2) == [0.0]
+    assert ctrl.ReadOne(3) == [0.0]
+
+    feed(ctrl, box.stream, frame(raw[20:]) + b"END 3 Ok\n")
+    ctrl.ReadAll()
+    # only the rows not read yet
+    assert ctrl.ReadOne(1) == [0.1, 0.1]
+    assert ctrl.ReadOne(2) == [1.5, 3.0]
+    assert ctrl.ReadOne(3) == [10.0, 20.0]
+    assert ctrl.data_ready == 3
+    assert box.pandabox.sent[-1] == "PCAP.ENABLE=ZERO"
+
+
+def test_read_one_software_trigger(box):
+    ctrl = box.ctrl()
+    ctrl.SetExtraAttributePar(3, "ChannelName", "INENC1.VAL")
+    ctrl.LoadOne(1, 0.5, 1)
+    feed(ctrl, box.stream, HEADER + frame(samples(1)))
+    ctrl.ReadAll()
+    value = ctrl.ReadOne(3)
+    assert isinstance(value, SardanaValue)
+    assert value.value == 0.0
+    assert ctrl.ReadOne(1).value == 0.5
+    # axis 2 has no channel enabled in the pandabox
+    with pytest.raises(ValueError):
+        ctrl.ReadOne(2)
+
+
+def test_pending_capture_coalesced(box):
+    ctrl = box.ctrl()
+    ctrl.SetExtraAttributePar(2, "AcquisitionMode", "Mean")
+    ctrl.SetExtraAttributePar(2, "ChannelName", "COUNTER1.OUT")
+    ctrl.SetExtraAttributePar(2, "ChannelName", "COUNTER2.OUT")
+    ctrl.SetExtraAttributePar(2, "AcquisitionMode", "Sum")
+    ctrl.LoadOne(1, 0.1, 1)
+    ctrl.StartAllCT()
+    assert box.pandabox.batches[-2] == [
+        "COUNTER1.OUT.CAPTURE=No",
+        "COUNTER2.OUT.CAPTURE=Sum",
+        "*PCAP.ARM=", "PCAP.ENABLE=ONE",
+        "PULSE1.ENABLE=ONE", "PULSE1.TRIG=ZERO", "PULSE1.TRIG=ONE"]
+    # sent once
+    ctrl.StartAllCT()
+    assert box.pandabox.batches[-2][0] == "*PCAP.ARM="
+
+
+def test_start_checks_the_arm_answer(box):
+    ctrl = box.ctrl()
+    ctrl.SetExtraAttributePar(2, "ChannelName", "COUNTER1.OUT")
+    ctrl.LoadOne(1, 0.1, 1)
+    # a failing capture change must not be taken for the arm answer
+    box.pandabox.answers["COUNTER1.OUT.CAPTURE=Value"] = "ERR bad"
+    ctrl.StartAllCT()
+    assert "*PCAP.DISARM=" not in box.pandabox.batches[-2]
+
+
+def test_start_rearms_when_arm_fails(box):
+    ctrl = box.ctrl()
+    ctrl.SetExtraAttributePar(2, "ChannelName", "COUNTER1.OUT")
+    ctrl.LoadOne(1, 0.1, 1)
+    box.pandabox.answers["*PCAP.ARM="] = ["ERR busy", "OK"]
+    ctrl.StartAllCT()
+    assert box.pandabox.batches[-2] == [
+        "PCAP.ENABLE=ZERO", "*PCAP.DISARM=",
+        "*PCAP.ARM=", "PCAP.ENABLE=ONE",
+        "PULSE1.ENABLE=ONE", "PULSE1.TRIG=ZERO", "PULSE1.TRIG=ONE"]
+
+
+def test_stream_error_raised_after_data(box):
+    ctrl = hardware_ctrl(box)
+    raw = samples(1)
+    feed(ctrl, box.stream, frame(raw))
+    box.stream.close()
+    ctrl._reader.join(1)
+    with pytest.raises(socket.error):
+        ctrl._ReadDataStream()
+    assert bytes(ctrl.data_buffer) == raw
+
+
+def test_delete_last_axis_then_add(box):
+    ctrl = box.ctrl()
+    first = box.pandabox
+    for axis in (1, 2, 3):
+        ctrl.DeleteDevice(axis)
+    assert first.users == 0
+    assert ctrl.pandabox is None
+    ctrl.AddDevice(1)
+    assert ctrl.pandabox is box.pandabox is not first
+    assert ctrl._reader.is_alive()
+    ctrl.LoadOne(1, 0.1, 1)
+    feed(ctrl, box.stream, HEADER + frame(samples(1)))
+    ctrl.ReadAll()
+    assert ctrl.ReadOne(1).value == 0.1
+
+
+def test_load_reopens_lost_stream(box):
+    ctrl = hardware_ctrl(box)
+    box.stream.close()
+    ctrl._reader.join(1)
+    assert ctrl._stream_error is not None
+    ctrl.LoadOne(1, 0.1, 1)
+    assert len(box.streams) == 2
+    assert ctrl._stream_error is None
+    assert box.stream.recv(1024) == b"FRAMED SCALED\n"
+    feed(ctrl, box.stream, HEADER + frame(samples(1)))
+    ctrl.ReadAll()
+    assert ctrl.ReadOne(2) == [0.0]
+
+
+def test_load_fails_when_stream_cannot_reopen(box, monkeypatch):
+    ctrl = hardware_ctrl(box)
+    box.stream.close()
+    ctrl._reader.join(1)
+
+    def refuse(ctrl):
+        raise socket.error("connection refused")
+
+    monkeypatch.setattr(coti.PandaboxCoTiCtrl, "_ConnectDataSocket", refuse)
+    with pytest.raises(Exception, match="data stream"):
+        ctrl.LoadOne(1, 0.1, 1)
+
+
+def test_read_all_raises_stream_error(box):
+    ctrl = hardware_ctrl(box)
+    feed(ctrl, box.stream, HEADER + frame(samples(1)))
+    ctrl.ReadAll()
+    box.stream.close()
+    ctrl._reader.join(1)
+    with pytest.raises(socket.error):
+        ctrl.ReadAll()
+    # the socket stays open until the next acquisition reopens the stream
+    assert ctrl.data_socket.fileno() != -1
+    ctrl.LoadOne(1, 0.1, 1)
+    assert ctrl._reader.is_alive()
+
+
+@pytest.mark.parametrize("answer, state", [
+    ("OK =Busy", State.Moving),
+    ("OK =Idle", State.On),
+    ("OK =", State.Fault),
+    ("ERR No such command", State.Fault),
+])
+def test_state_from_pcap_status(box, answer, state):
+    ctrl = box.ctrl()
+    box.pandabox.answers["*PCAP.STATUS?"] = answer
+    ctrl.StateAll()
+    assert ctrl.StateOne(2) == (state, answer)
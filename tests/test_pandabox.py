@@ -0,0 +1,72 @@
+"""Tests of the PandA control protocol client."""
+
+import socket
+
+import pytest
+
+pytest.importorskip("pandaboxlib")
+
+from sardana_pandabox.pandabox import PandABox, TimedCache  # noqa: E402
+
+
+@pytest.fixture
+def pandabox():
+    """PandABox talking to the local end of a socket pair."""
+    client, server = socket.socketpair()
+    box = PandABox("localhost")
+    box.sock = client
+    yield box, server
+    client.close()
+    server.close()
+
+
+def test_query_many_sends_one_line_per_command(pandabox):
+    box, server = pandabox
+    server.sendall(b"OK\nOK\n")
+    assert box.query_many(["PCAP.ENABLE=ZERO", "*PCAP.DISARM="]) == \
+        ["OK", "OK"]
+    assert server.recv(1024) == b"PCAP.ENABLE=ZERO\n*PCAP.DISARM=\n"
+
+
+def test_query_many_multiline_response(pandabox):
+    box, server = pandabox
+    server.sendall(b"OK =Busy\n!PCAP.ARM\n!PCAP.DISARM\n.\nERR unknown\n")
+    assert box.query_many(["*PCAP.STATUS?", "*BLOCKS?", "FOO?"]) == \
+        ["OK =Busy", ["PCAP.ARM", "PCAP.DISARM"], "ERR unknown"]
+
+
+def test_recv_responses_split_across_reads(pandabox):
+    box, server = pandabox
+    box._rxview = box._rxview[:5]
+    server.sendall(b"!a\n!bc\n.\nOK =3\n")
+    assert box._recv_responses(2) == [["a", "bc"], "OK =3"]
+
+
+def test_recv_responses_closed_connection(pandabox):
+    box, server = pandabox
+    server.sendall(b"OK\n")
+    server.close()
+    with pytest.raises(IOError):
+        box._recv_responses(2)
+
+
+def test_timed_cache_reads_once_per_ttl():
+    reads = []
+    cache = TimedCache(60)
+    assert cache.get(lambda: reads.append(1) or len(reads)) == 1
+    assert cache.get(lambda: reads.append(1) or len(reads)) == 1
+    cache.invalidate()
+    assert cache.get(lambda: reads.append(1) or len(reads)) == 2
+    cache.set(5)
+    assert cache.get(lambda: reads.append(1) or len(reads)) == 5
+
+
+def test_timed_cache_does_not_keep_failures():
+    cache = TimedCache(60)
+
+    def fail():
+        raise IOError("no answer")
+
+    with pytest.raises(IOError):
+        cache.get(fail)
+    assert cache.get(lambda: 3) == 3
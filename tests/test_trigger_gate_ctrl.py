@@ -0,0 +1,73 @@
+"""Tests of PandaBoxTriggerGateCtrl against a fake PandABox."""
+
+import pytest
+
+pytest.importorskip("tango")
+pytest.importorskip("sardana")
+pytest.importorskip("pandaboxlib")
+
+import tango  # noqa: E402
+
+from sardana_pandabox.ctrl import \
+    PandaBoxTriggerGateController as tg  # noqa: E402
+
+from fakes import FakePandA  # noqa: E402
+
+PROPS = {"pandaboxhostname": "pandabox", "acq_delay": 0.0,
+         "trigger_block": "PULSE1"}
+
+
+@pytest.fixture
+def pandaboxes(monkeypatch):
+    pandaboxes = []
+
+    def get_pandabox(host):
+        pandabox = FakePandA(host)
+        pandabox.answers["PULSE1.QUEUED?"] = "OK =0"
+        pandaboxes.append(pandabox)
+        return pandabox
+
+    def release_pandabox(pandabox):
+        pandabox.users -= 1
+
+    monkeypatch.setattr(tg, "get_pandabox", get_pandabox)
+    monkeypatch.setattr(tg, "release_pandabox", release_pandabox)
+    return pandaboxes
+
+
+@pytest.fixture
+def ctrl(pandaboxes):
+    ctrl = tg.PandaBoxTriggerGateCtrl("pandabox_tg", dict(PROPS))
+    ctrl.AddDevice(1)
+    yield ctrl
+    # released while the fakes are in place
+    ctrl.release()
+
+
+def test_delete_last_axis_then_add(ctrl, pandaboxes):
+    ctrl.DeleteDevice(1)
+    assert pandaboxes[0].users == 0
+    ctrl.AddDevice(1)
+    assert len(pandaboxes) == 2
+    assert ctrl.StateOne(1) == (tango.DevState.ON, "Standby")
+    ctrl.StartOne(1)
+    assert pandaboxes[1].sent[-2:] == ["PULSE1.ENABLE=ONE", "PULSE1.TRIG=ONE"]
+
+
+def test_state_fault_when_pandabox_does_not_answer(ctrl, pandaboxes):
+
+    def closed(cmd):
+        raise IOError("PandABox closed the control connection")
+
+    pandaboxes[0].numquery = closed
+    assert ctrl.StateOne(1) == (tango.DevState.FAULT,
+                                "Panda Box is not responding.")
+    # the failure is not cached
+    del pandaboxes[0].numquery
+    assert ctrl.StateOne(1) == (tango.DevState.ON, "Standby")
+
+
+def test_state_raises_programming_errors(ctrl):
+    ctrl.DeleteDevice(1)
+    with pytest.raises(AttributeError):
+        ctrl.StateOne(1)